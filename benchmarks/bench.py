@@ -0,0 +1,228 @@
+"""
+Benchmarks for key building, the stores, concurrent access and import time.
+
+    python -m benchmarks.bench --output results.json
+    python -m benchmarks.bench --compare results.json
+
+Results are written as json so runs on different versions can be compared with --compare.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+import uuid
+from datetime import datetime
+
+from devcache.cache import _get_function_arg_str
+from devcache.storage import MemoryStore, SharedMemoryStore, SqliteStore
+
+PAYLOAD_SIZES = [100, 10 * 1024, 1024 * 1024]
+
+
+def _time(func, repeat):
+    """
+    Returns the median seconds per call of func over repeat runs
+    """
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return statistics.median(t / number for t in timer.repeat(repeat=repeat, number=number))
+
+
+def _result(name, seconds, **params):
+    return {'name': name, 'params': params, 'seconds': seconds, 'ops_per_sec': 1 / seconds if seconds else None}
+
+
+def _make_function(n):
+    namespace = {}
+    exec(f'def f({", ".join(f"a{i}" for i in range(n))}): pass', namespace)
+    return namespace['f']
+
+
+def bench_key_building(repeat):
+    results = []
+    for n in [1, 4, 16, 64]:
+        func = _make_function(n)
+        for size in [10, 1024, 100 * 1024]:
+            args = ['x' * size] * n
+            seconds = _time(lambda: _get_function_arg_str(func, args, {}, None, []), repeat)
+            results.append(_result('key_building', seconds, args=n, arg_size=size))
+    return results
+
+
+def _stores(temp_dir):
+    shm = SharedMemoryStore(f'devcache_bench_{uuid.uuid4().hex[:12]}', slots=256, slot_size=2 * 1024 * 1024)
+    return {'memory': MemoryStore(), 'sqlite': SqliteStore(temp_dir), 'shared_memory': shm}
+
+
+def _close(stores):
+    stores['sqlite'].close()
+    stores['shared_memory'].close()
+    stores['shared_memory'].unlink()
+
+
+def bench_stores(repeat):
+    results = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        stores = _stores(temp_dir)
+        try:
+            for store_name, store in stores.items():
+                store.store('hit', 'x' * 100)
+                results.append(_result('hit', _time(lambda: store.get('hit'), repeat), store=store_name))
+                results.append(_result('miss', _time(lambda: store.get('miss'), repeat), store=store_name))
+                for size in PAYLOAD_SIZES:
+                    payload = os.urandom(size)
+                    seconds = _time(lambda: store.store('payload', payload), repeat)
+                    results.append(_result('store', seconds, store=store_name, payload_size=size))
+                    seconds = _time(lambda: store.get('payload'), repeat)
+                    results.append(_result('get', seconds, store=store_name, payload_size=size))
+        finally:
+            _close(stores)
+    return results
+
+
+def _hammer(store, ops, index):
+    for i in range(ops):
+        key = f'{index}.{i % 100}'
+        if i % 10 == 0:
+            store.store(key, i)
+        else:
+            store.get(key)
+
+
+def bench_threads(repeat, ops=2000):
+    results = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        store = SqliteStore(temp_dir)
+        try:
+            for n in [1, 4, 16]:
+                timings = []
+                for _ in range(repeat):
+                    threads = [threading.Thread(target=_hammer, args=(store, ops, i)) for i in range(n)]
+                    start = time.perf_counter()
+                    for t in threads:
+                        t.start()
+                    for t in threads:
+                        t.join()
+                    timings.append((time.perf_counter() - start) / (ops * n))
+                results.append(_result('threads', statistics.median(timings), store='sqlite', threads=n))
+        finally:
+            store.close()
+    return results
+
+
+def _process_worker(temp_dir, ops, index, barrier, elapsed):
+    store = SqliteStore(temp_dir)
+    store.conn.execute('PRAGMA busy_timeout = 30000')
+    barrier.wait()
+    start = time.perf_counter()
+    _hammer(store, ops, index)
+    elapsed.put(time.perf_counter() - start)
+    store.close()
+
+
+def bench_processes(repeat, ops=1000):
+    """
+    Workers time their own loop, started together from a barrier, so process start up and opening the store
+    aren't counted
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        SqliteStore(temp_dir).close()
+        for n in [1, 4, 8]:
+            timings = []
+            for _ in range(repeat):
+                barrier = multiprocessing.Barrier(n)
+                elapsed = multiprocessing.Queue()
+                processes = [multiprocessing.Process(target=_process_worker,
+                                                     args=(temp_dir, ops, i, barrier, elapsed))
+                             for i in range(n)]
+                for p in processes:
+                    p.start()
+                # read before joining, a process won't exit while its queued data is unread
+                worker_seconds = [elapsed.get() for _ in processes]
+                for p in processes:
+                    p.join()
+                timings.append(max(worker_seconds) / (ops * n))
+            results.append(_result('processes', statistics.median(timings), store='sqlite', processes=n))
+    return results
+
+
+def bench_import(repeat):
+    timings = []
+    with tempfile.TemporaryDirectory() as home:
+        # importing devcache opens ~/.devcache, keep it away from the real one
+        os.mkdir(os.path.join(home, '.devcache'))
+        env = dict(os.environ, HOME=home, USERPROFILE=home)
+        code = 'import time; t = time.perf_counter(); import devcache; print(time.perf_counter() - t)'
+        for _ in range(max(repeat, 5)):
+            out = subprocess.run([sys.executable, '-c', code], env=env, check=True, capture_output=True, text=True)
+            timings.append(float(out.stdout))
+    return [_result('import', statistics.median(timings))]
+
+
+BENCHMARKS = {
+    'key_building': bench_key_building,
+    'stores': bench_stores,
+    'threads': bench_threads,
+    'processes': bench_processes,
+    'import': bench_import,
+}
+
+
+def _id(result):
+    return result['name'], json.dumps(result['params'], sort_keys=True)
+
+
+def compare(results, baseline):
+    """
+    Prints the change in seconds per op against a previous run, positive is slower
+    """
+    previous = {_id(r): r for r in baseline['results']}
+    for r in results:
+        p = previous.get(_id(r))
+        change = f'{(r["seconds"] / p["seconds"] - 1) * 100:+.1f}%' if p and p['seconds'] else 'new'
+        print(f'{r["name"]:<14} {_id(r)[1]:<60} {r["seconds"]:.3e}s  {change}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run devcache benchmarks')
+    parser.add_argument('benchmarks', nargs='*', help=f'any of {", ".join(BENCHMARKS)}, all when not given')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', default=None, help='write json results to this file')
+    parser.add_argument('--compare', default=None, help='json results of a previous run')
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f'unknown benchmarks: {", ".join(unknown)} (choose from {", ".join(BENCHMARKS)})')
+
+    results = []
+    for name in args.benchmarks or BENCHMARKS:
+        print(f'running {name}...', file=sys.stderr)
+        results += BENCHMARKS[name](args.repeat)
+    report = {
+        'created': datetime.utcnow().isoformat(),
+        'python': sys.version,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+    elif not args.output:
+        json.dump(report, sys.stdout, indent=2)
+
+
+if __name__ == '__main__':
+    main()
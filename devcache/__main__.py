@@ -0,0 +1,105 @@
+import argparse
+import os
+import re
+import sys
+from datetime import datetime, timedelta
+
+from devcache.storage import DEFAULT_DIR, SqliteStore, attach_hot_stash
+
+
+def _pattern(value):
+    try:
+        re.compile(value)
+    except re.error as e:
+        raise argparse.ArgumentTypeError(f'invalid pattern {value}: {e}')
+    return value
+
+
+def _positive_int(value):
+    n = int(value)
+    if n < 1:
+        raise argparse.ArgumentTypeError(f'{value} is less than 1')
+    return n
+
+
+def _hours_ago(hours):
+    return datetime.utcnow() - timedelta(hours=hours) if hours is not None else None
+
+
+def ls(store, args):
+    for index, (key, tag, timestamp, size) in enumerate(store._iter_ls(tag=args.tag, pattern=args.pattern,
+                                                                        limit=args.limit,
+                                                                        page_size=args.page_size)):
+        print(f'{index}: {key}\t{tag}\t{timestamp}\t{size}')
+
+
+def stats(store, args):
+    total_count = total_size = 0
+    print('tag\tcount\tsize\toldest\tnewest')
+    for tag, v in sorted(store.stats().items(), key=lambda x: str(x[0])):
+        print(f'{tag}\t{v["count"]}\t{v["size"]}\t{v["oldest"]}\t{v["newest"]}')
+        total_count += v['count']
+        total_size += v['size']
+    print(f'total\t{total_count}\t{total_size}')
+
+
+def purge(store, args):
+    older_than = _hours_ago(args.older_than_hours)
+    if not (args.tag or older_than or args.pattern or args.all or args.shared_memory):
+        sys.exit('purge needs --tag, --older-than-hours, --pattern, --all or --shared-memory')
+    if args.all:
+        store.clear()
+        print('deleted everything')
+    elif args.tag or older_than or args.pattern:
+        print(f'deleted {store.purge(tag=args.tag, older_than=older_than, pattern=args.pattern)}')
+    if args.shared_memory:
+        for hot in store.listeners:
+            hot.unlink()
+            print(f'removed shared memory: {hot.name}')
+        if not store.listeners:
+            print('no shared memory')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='devcache', description='Manage the devcache stash')
+    parser.add_argument('--data-dir', default=os.path.join(DEFAULT_DIR, 'stash.db'))
+    parser.add_argument('--db-file-name', default=None)
+    parser.add_argument('--shared-memory-name', default=None,
+                        help='shared memory tier to keep in sync, when it was given a name in the config')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    ls_parser = commands.add_parser('ls', help='list keys, oldest first')
+    ls_parser.add_argument('--tag', default=None)
+    ls_parser.add_argument('--pattern', type=_pattern, default=None, help='regex matched against the start of the key')
+    ls_parser.add_argument('--limit', type=int, default=None)
+    ls_parser.add_argument('--page-size', type=_positive_int, default=1000)
+    ls_parser.set_defaults(func=ls)
+
+    stats_parser = commands.add_parser('stats', help='count and size per tag')
+    stats_parser.set_defaults(func=stats)
+
+    purge_parser = commands.add_parser('purge', help='delete items matching all the given filters')
+    purge_parser.add_argument('--tag', default=None)
+    purge_parser.add_argument('--pattern', type=_pattern, default=None,
+                              help='regex matched against the start of the key')
+    purge_parser.add_argument('--older-than-hours', type=float, default=None)
+    purge_parser.add_argument('--all', action='store_true')
+    purge_parser.add_argument('--shared-memory', action='store_true', help='remove the shared memory tier')
+    purge_parser.set_defaults(func=purge)
+
+    args = parser.parse_args(argv)
+    store = SqliteStore(args.data_dir, args.db_file_name)
+    hot = attach_hot_stash(store, args.shared_memory_name)
+    try:
+        args.func(store, args)
+    except BrokenPipeError:
+        # output was piped into something like head, python would complain again flushing stdout on exit
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+    finally:
+        store.close()
+        if hot:
+            hot.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,47 +1,68 @@
 import inspect
 import logging
 import os
+import pickle
 import re
 from copy import copy
 from functools import wraps
 from hashlib import md5
 
-import yaml
-
-from devcache.storage import SqliteStore
+from devcache.storage import DEFAULT_DIR, SharedMemoryStore, SqliteStore, TieredStore, default_hot_stash_name
 
 logger = logging.getLogger(__name__)
 
-DEFAULT_DIR = os.path.expanduser(r'~/.devcache')
-
 DEFAULT_CONFIG = os.path.join(DEFAULT_DIR, 'devcache.yaml')
 
+CONFIG_SNAPSHOT_DIR = os.path.join(DEFAULT_DIR, 'config_snapshots')
+
 stash = SqliteStore(os.path.join(DEFAULT_DIR, 'stash.db'))
 
 configs = {}
 
+config_rules = {}
 
-def get_config(file_name):
-    if isinstance(file_name, str):
-        config = configs.get(file_name)
-        if not config:
-            try:
-                with open(file_name) as f:
-                    config = yaml.safe_load(f)
-            except Exception:
-                logger.warning(f'Could not load file_name: {file_name}.  Disabling')
-                config = {'enabled': False}
-    else:
-        try:
-            config = yaml.safe_load(file_name)
-        except Exception:
-            logger.warning(f'Could not load supplied file: {file_name}.  Disabling')
-            config = {'enabled': False}
-    configs[file_name] = config
-    return config
+hot_stashes = {}
+
+remote_stashes = {}
 
 
-def _resolve_props(config, function_group, key):
+def get_hot_stash(options):
+    if not options:
+        return None
+    options = options if isinstance(options, dict) else {}
+    name = options.get('name') or default_hot_stash_name()
+    hot = hot_stashes.get(name)
+    if not hot:
+        try:
+            hot = SharedMemoryStore(name,
+                                    slots=options.get('slots', 1024),
+                                    slot_size=options.get('slot_size', 64 * 1024),
+                                    ways=options.get('ways', 4))
+        except Exception:
+            logger.warning(f'Could not attach shared memory: {name}.  Not using it')
+            return None
+        hot_stashes[name] = hot
+    return hot
+
+
+def get_remote_stash(address):
+    if not address:
+        return None
+    address = str(address)
+    remote = remote_stashes.get(address)
+    if not remote:
+        # the client pulls in socket, json etc, only worth importing when a server is configured
+        from devcache.remote import RemoteStore
+
+        remote = remote_stashes[address] = RemoteStore(address)
+    return remote
+
+
+def _compile_rules(config):
+    """
+    Validated, enabled props in match order as (group, compiled pattern, props)
+    """
+    rules = []
     for k, v in sorted(config.get('props', {}).items()):
         valid_keys = {'enabled', 'use_cache', 'group', 'pattern'}
         extra_keys = set(v.keys()) - valid_keys
@@ -56,21 +77,86 @@ def _resolve_props(config, function_group, key):
         if not enabled:
             logger.info(f'{v} not enabled... skipping')
             continue
-        if group and group == function_group:
-            if not pattern:
-                return v
+        if pattern:
             try:
-                if re.match(pattern, key):
-                    return v
-            except:
+                pattern = re.compile(pattern)
+            except Exception:
                 logger.warning(f'Pattern {pattern} for rule {k}, failed.  Ignoring')
+                continue
+        rules.append((group, pattern, v))
+    return rules
 
-        if pattern:
+
+def _parse_config(f):
+    # yaml is only needed when there's no up to date snapshot, so don't pay for importing it otherwise
+    import yaml
+
+    config = yaml.safe_load(f) or {}
+    return config, _compile_rules(config)
+
+
+def _snapshot_file(file_name):
+    return os.path.join(CONFIG_SNAPSHOT_DIR, f'{md5(os.path.abspath(file_name).encode("utf-8")).hexdigest()}.pickle')
+
+
+def _load_config_file(file_name):
+    """
+    Returns (config, rules).  Reuses the snapshot written by an earlier process while the file's mtime and size
+    are unchanged, which skips importing yaml and parsing the file.
+    """
+    stat = os.stat(file_name)
+    stamp = (os.path.abspath(file_name), stat.st_mtime_ns, stat.st_size)
+    snapshot_file = _snapshot_file(file_name)
+    try:
+        with open(snapshot_file, 'rb') as f:
+            snapshot = pickle.load(f)
+        if snapshot['stamp'] == stamp:
+            return snapshot['config'], snapshot['rules']
+    except Exception:
+        pass
+    with open(file_name) as f:
+        config, rules = _parse_config(f)
+    try:
+        os.makedirs(CONFIG_SNAPSHOT_DIR, exist_ok=True)
+        tmp_file = f'{snapshot_file}.{os.getpid()}.tmp'
+        with open(tmp_file, 'wb') as f:
+            pickle.dump({'stamp': stamp, 'config': config, 'rules': rules}, f)
+        os.replace(tmp_file, snapshot_file)
+    except Exception:
+        logger.info(f'Could not write config snapshot: {snapshot_file}')
+    return config, rules
+
+
+def get_config(file_name):
+    """
+    Loads and caches the config, its rules are cached in config_rules under the same file_name
+    """
+    if isinstance(file_name, str):
+        config = configs.get(file_name)
+        if not config:
             try:
-                if re.match(pattern, key):
-                    return v
-            except:
-                logger.warning(f'Pattern {pattern} for rule {k}, failed.  Ignoring')
+                config, config_rules[file_name] = _load_config_file(file_name)
+            except Exception:
+                logger.warning(f'Could not load file_name: {file_name}.  Disabling')
+                config = {'enabled': False}
+    else:
+        try:
+            config, config_rules[file_name] = _parse_config(file_name)
+        except Exception:
+            logger.warning(f'Could not load supplied file: {file_name}.  Disabling')
+            config = {'enabled': False}
+    configs[file_name] = config
+    return config
+
+
+def _resolve_props(config, function_group, key, rules=None):
+    if rules is None:
+        rules = _compile_rules(config)
+    for group, pattern, v in rules:
+        if group and group == function_group and not pattern:
+            return v
+        if pattern and pattern.match(key):
+            return v
 
     return {}
 
@@ -111,11 +197,13 @@ def _get_function_arg_str(func, function_args, function_kwargs, key_args=None, i
 
 
 def devcache(config_file=None, group=None, key_args=None, ignore_key_args=None):
-    config = get_config(config_file or DEFAULT_CONFIG)
+    config_file = config_file or DEFAULT_CONFIG
+    config = get_config(config_file)
+    rules = config_rules.get(config_file)
 
     def decorator(func):
         function_name = f'{func.__module__}.{func.__qualname__}.{func.__name__}'
-        props = _resolve_props(config, group, function_name)
+        props = _resolve_props(config, group, function_name, rules)
         if not props:
             logger.warning(f'Not props found for group/function_name:  {group}/{function_name}.  Not caching')
         enabled = config.get('enabled', True)
@@ -135,19 +223,37 @@ def devcache(config_file=None, group=None, key_args=None, ignore_key_args=None):
 
             return _pass
 
+        hot = get_hot_stash(config.get('shared_memory'))
+        remote = get_remote_stash(config.get('server'))
+        if hot and remote:
+            logger.warning('shared_memory is not invalidated by changes made on the server or by other hosts')
+
         @wraps(func)
         def wrap(*args, **kwargs):
+            # stash is looked up per call so patching devcache.cache.stash still applies to decorated functions
+            cold = remote or stash
+            cache = TieredStore(hot, cold) if hot else cold
             kp = f'{key_prefix}.' if key_prefix else ''
             args_str = _get_function_arg_str(func, args, kwargs, key_args, ignore_key_args)
             key = f'{kp}{function_name}{args_str}'
 
-            if not refresh and use_cache and stash.exists(key):
-                logger.info(f'retrieving {key} from cache')
-                return stash.get(key)
+            if not refresh and use_cache:
+                try:
+                    result = cache.get(key, raise_key_error=True)
+                    logger.info(f'retrieving {key} from cache')
+                    return result
+                except KeyError:
+                    pass
+                except OSError as e:
+                    # e.g. the cache server is down, carry on without the cache
+                    logger.warning(f'Could not read {key} from cache: {e}')
 
             result = func(*args, **kwargs)
             logger.info(f'will stash to key (refresh: {refresh}): {key}. obj: {str(result)[:25]}')
-            stash.store(key, result, tag=group)
+            try:
+                cache.store(key, result, tag=group)
+            except OSError as e:
+                logger.warning(f'Could not stash {key}: {e}')
             return result
 
         return wrap
@@ -0,0 +1,348 @@
+import argparse
+import json
+import logging
+import os
+import pickle
+import queue
+import socket
+import socketserver
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from devcache.storage import SqliteStore
+
+logger = logging.getLogger(__name__)
+
+# Every message is a length prefixed frame.  A request is a json header frame, followed by one raw frame per value
+# it carries.  A response is a json header frame followed by the raw value frames it announces in 'values'.
+# Frames are sent and received in chunks but each value is held whole in memory on both sides.
+_frame_header = struct.Struct('!Q')
+
+CHUNK_SIZE = 1024 * 1024
+
+# Larger frames are refused before anything is allocated for them
+MAX_HEADER_SIZE = 64 * 1024
+MAX_VALUE_SIZE = 1024 * 1024 * 1024
+
+# Requests in flight per round trip.  Bounded so neither side can fill both socket buffers and deadlock.
+PIPELINE_DEPTH = 64
+
+
+def _send_frame(sock, data):
+    sock.sendall(_frame_header.pack(len(data)))
+    view = memoryview(data)
+    for start in range(0, len(view), CHUNK_SIZE):
+        sock.sendall(view[start:start + CHUNK_SIZE])
+
+
+def _recv_exact(sock, size):
+    data = bytearray(size)
+    view = memoryview(data)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:], min(size - received, CHUNK_SIZE))
+        if not n:
+            raise ConnectionError('Connection closed')
+        received += n
+    return data
+
+
+def _recv_frame(sock, max_size=MAX_VALUE_SIZE):
+    size, = _frame_header.unpack(_recv_exact(sock, _frame_header.size))
+    if size > max_size:
+        raise ValueError(f'Frame of {size} bytes is over the {max_size} byte limit')
+    return _recv_exact(sock, size)
+
+
+def _send_message(sock, header, values=()):
+    _send_frame(sock, json.dumps(header).encode('utf-8'))
+    for value in values:
+        _send_frame(sock, value)
+
+
+def _recv_header(sock):
+    return json.loads(_recv_frame(sock, MAX_HEADER_SIZE).decode('utf-8'))
+
+
+def _parse_address(address):
+    if isinstance(address, (tuple, list)):
+        return socket.AF_INET, (address[0], int(address[1]))
+    host, sep, port = str(address).rpartition(':')
+    if sep and port.isdigit():
+        return socket.AF_INET, (host or 'localhost', int(port))
+    if not hasattr(socket, 'AF_UNIX'):
+        raise ValueError(f'{address} is not host:port and unix sockets are not supported on this platform')
+    return socket.AF_UNIX, os.path.expanduser(address)
+
+
+class RemoteStore:
+    """
+    Client for a CacheServer, has the same interface as the local stores.  Connections are pooled, bulk
+    operations are pipelined over a single connection.  After a failed connect or a timeout the server is
+    skipped for ``retry_after`` seconds, operations raise ConnectionError straight away meanwhile.
+    """
+
+    def __init__(self, address, pool_size=4, timeout=30, connect_timeout=2, retry_after=30):
+        self.family, self.address = _parse_address(address)
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.retry_after = retry_after
+        self.down_until = 0
+        self.pool = queue.LifoQueue(maxsize=pool_size)
+
+    def _mark_down(self):
+        self.down_until = time.monotonic() + self.retry_after
+
+    def _connect(self):
+        sock = socket.socket(self.family, socket.SOCK_STREAM)
+        sock.settimeout(self.connect_timeout)
+        if self.family == socket.AF_INET:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            sock.connect(self.address)
+        except OSError:
+            sock.close()
+            self._mark_down()
+            raise
+        sock.settimeout(self.timeout)
+        return sock
+
+    @contextmanager
+    def _connection(self):
+        try:
+            sock = self.pool.get_nowait()
+        except queue.Empty:
+            sock = self._connect()
+        try:
+            yield sock
+        except socket.timeout:
+            sock.close()
+            self._mark_down()
+            raise
+        except Exception:
+            sock.close()
+            raise
+        try:
+            self.pool.put_nowait(sock)
+        except queue.Full:
+            sock.close()
+
+    def _pipeline(self, requests):
+        """
+        Sends (header, values) requests PIPELINE_DEPTH at a time before reading their responses.
+        Returns (header, values) responses in the same order.
+        """
+        if time.monotonic() < self.down_until:
+            raise ConnectionError(f'Cache server {self.address} was unreachable, skipping it for now')
+        try:
+            return self._send_pipeline(requests)
+        except ConnectionError:
+            if time.monotonic() < self.down_until:
+                # connecting failed, trying again straight away would only double the wait
+                raise
+            # pooled connections go stale when the server restarts, every op is safe to resend once
+            self.close()
+            return self._send_pipeline(requests)
+
+    def _send_pipeline(self, requests):
+        responses = []
+        with self._connection() as sock:
+            for start in range(0, len(requests), PIPELINE_DEPTH):
+                batch = requests[start:start + PIPELINE_DEPTH]
+                for header, values in batch:
+                    _send_message(sock, header, values)
+                for _ in batch:
+                    header = _recv_header(sock)
+                    values = [_recv_frame(sock) for _ in range(header.get('values', 0))]
+                    responses.append((header, values))
+        return responses
+
+    def _raise(self, header):
+        if header.get('error') == 'KeyError':
+            raise KeyError(header.get('message'))
+        raise RuntimeError(f'{header.get("error")}: {header.get("message")}')
+
+    def _call(self, op, values=(), **kwargs):
+        header, values = self._pipeline([(dict(op=op, **kwargs), values)])[0]
+        if not header['ok']:
+            self._raise(header)
+        return header.get('result'), values
+
+    def _dumps(self, obj):
+        value = pickle.dumps(obj, protocol=5)
+        if len(value) > MAX_VALUE_SIZE:
+            raise ValueError(f'{len(value)} bytes is over the server\'s {MAX_VALUE_SIZE} byte limit')
+        return value
+
+    def store(self, key, obj, tag=None):
+        self._call('store', [self._dumps(obj)], key=str(key), tag=tag)
+
+    def get(self, key, raise_key_error=False):
+        try:
+            _, values = self._call('get', key=str(key))
+        except KeyError:
+            if raise_key_error:
+                raise
+            return None
+        return pickle.loads(values[0])
+
+    def exists(self, key):
+        return self._call('exists', key=str(key))[0]
+
+    def delete(self, key):
+        self._call('delete', key=str(key))
+
+    def delete_by_tag(self, tag):
+        self._call('delete_by_tag', tag=tag)
+
+    def delete_older(self, ref_time_utc):
+        self._call('delete_older', ref_time_utc=ref_time_utc.isoformat())
+
+    def clear(self):
+        self._call('clear')
+
+    def store_many(self, items, tag=None):
+        requests = [(dict(op='store', key=str(k), tag=tag), [self._dumps(v)]) for k, v in items.items()]
+        for header, _ in self._pipeline(requests):
+            if not header['ok']:
+                self._raise(header)
+
+    def get_many(self, keys):
+        """
+        Returns a dict of the keys that are in the store
+        """
+        keys = list(keys)
+        responses = self._pipeline([(dict(op='get', key=str(k)), []) for k in keys])
+        result = {}
+        for key, (header, values) in zip(keys, responses):
+            if header['ok']:
+                result[key] = pickle.loads(values[0])
+            elif header.get('error') != 'KeyError':
+                self._raise(header)
+        return result
+
+    def delete_many(self, keys):
+        for header, _ in self._pipeline([(dict(op='delete', key=str(k)), []) for k in keys]):
+            if not header['ok']:
+                self._raise(header)
+
+    def close(self):
+        while True:
+            try:
+                self.pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class _Handler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        while True:
+            # anything unreadable or too large drops the connection
+            try:
+                header = _recv_header(self.request)
+                values = [_recv_frame(self.request)] if header.get('op') == 'store' else []
+            except (OSError, ValueError, AttributeError, MemoryError):
+                return
+            try:
+                with self.server.lock:
+                    result, values = self.server.dispatch(header, values)
+                response = dict(ok=True, result=result, values=len(values))
+            except Exception as e:
+                response = dict(ok=False, error=type(e).__name__, message=str(e))
+                values = []
+            try:
+                _send_message(self.request, response, values)
+            except OSError:
+                return
+
+
+class _ServerMixin:
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def dispatch(self, header, values):
+        op = header.get('op')
+        if op == 'store':
+            self.store._store_raw(header['key'], values[0], tag=header.get('tag'))
+        elif op == 'get':
+            return None, [self.store._get_raw(header['key'])]
+        elif op == 'exists':
+            return bool(self.store.exists(header['key'])), []
+        elif op == 'delete':
+            self.store.delete(header['key'])
+        elif op == 'delete_by_tag':
+            self.store.delete_by_tag(header.get('tag'))
+        elif op == 'delete_older':
+            self.store.delete_older(datetime.fromisoformat(header['ref_time_utc']))
+        elif op == 'clear':
+            self.store.clear()
+        else:
+            raise ValueError(f'Unknown op: {op}')
+        return None, []
+
+
+class _TCPServer(_ServerMixin, socketserver.ThreadingTCPServer):
+    pass
+
+
+if hasattr(socketserver, 'ThreadingUnixStreamServer'):
+    class _UnixServer(_ServerMixin, socketserver.ThreadingUnixStreamServer):
+        pass
+else:
+    _UnixServer = None
+
+
+class CacheServer:
+    """
+    Serves a SqliteStore over TCP ('host:port' or (host, port)) or a unix socket path.  Values sent by clients
+    are stored as the pickled bytes they arrived as, the same format the store uses itself, so the server never
+    unpickles them.
+    """
+
+    def __init__(self, store, address):
+        family, address = _parse_address(address)
+        if family != socket.AF_INET and _UnixServer is None:
+            raise ValueError(f'Can not serve on {address}, unix socket servers are not supported on this platform')
+        if family != socket.AF_INET and os.path.exists(address):
+            os.remove(address)
+        self.server = (_TCPServer if family == socket.AF_INET else _UnixServer)(address, _Handler)
+        self.server.store = store
+        self.server.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def address(self):
+        address = self.server.server_address
+        return address if isinstance(address, str) else f'{address[0]}:{address[1]}'
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.server.address_family != socket.AF_INET and os.path.exists(self.server.server_address):
+            os.remove(self.server.server_address)
+        if self.thread:
+            self.thread.join()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve a devcache store to other hosts')
+    parser.add_argument('address', help='host:port or unix socket path')
+    parser.add_argument('--data-dir', default=os.path.expanduser(r'~/.devcache/stash.db'))
+    parser.add_argument('--db-file-name', default=None)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    cache_server = CacheServer(SqliteStore(args.data_dir, args.db_file_name), args.address)
+    logger.info(f'serving {args.data_dir} on {cache_server.address}')
+    cache_server.serve_forever()
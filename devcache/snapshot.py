@@ -0,0 +1,163 @@
+import argparse
+import logging
+import os
+import struct
+import tempfile
+import zlib
+from contextlib import ExitStack
+from datetime import datetime, timedelta
+
+from devcache.storage import DEFAULT_DIR, SqliteStore, attach_hot_stash
+
+logger = logging.getLogger(__name__)
+
+# Snapshot layout:  MAGIC, then chunks of (raw length, compressed length, zlib data), ended by a (0, 0) chunk.
+# A chunk holds records of (key, tag, timestamp, value lengths) followed by those bytes.  Values are kept as the
+# pickled bytes they are stored as, they're never unpickled on the way through.
+MAGIC = b'DVCSNAP1'
+
+_chunk_header = struct.Struct('!II')
+_record_header = struct.Struct('!iIII')
+
+CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def _pack(row):
+    key, tag, value, timestamp = row
+    tag_bytes = b'' if tag is None else tag.encode('utf-8')
+    tag_len = -1 if tag is None else len(tag_bytes)
+    key = str(key).encode('utf-8')
+    timestamp = str(timestamp).encode('utf-8')
+    value = bytes(value)
+    header = _record_header.pack(tag_len, len(key), len(timestamp), len(value))
+    return b''.join((header, key, tag_bytes, timestamp, value))
+
+
+def _unpack(chunk):
+    offset = 0
+    while offset < len(chunk):
+        tag_len, key_len, timestamp_len, value_len = _record_header.unpack_from(chunk, offset)
+        offset += _record_header.size
+        key = chunk[offset:offset + key_len].decode('utf-8')
+        offset += key_len
+        tag = None
+        if tag_len >= 0:
+            tag = chunk[offset:offset + tag_len].decode('utf-8')
+            offset += tag_len
+        timestamp = chunk[offset:offset + timestamp_len].decode('utf-8')
+        offset += timestamp_len
+        value = chunk[offset:offset + value_len]
+        offset += value_len
+        yield key, tag, value, timestamp
+
+
+def _write_chunk(f, records, level):
+    raw = b''.join(records)
+    data = zlib.compress(raw, level)
+    f.write(_chunk_header.pack(len(raw), len(data)))
+    f.write(data)
+
+
+def _read_chunks(f):
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError(f'{f.name} is not a devcache snapshot')
+    while True:
+        header = f.read(_chunk_header.size)
+        if len(header) != _chunk_header.size:
+            raise ValueError(f'{f.name} is truncated')
+        raw_len, data_len = _chunk_header.unpack(header)
+        if not data_len:
+            return
+        data = f.read(data_len)
+        if len(data) != data_len:
+            raise ValueError(f'{f.name} is truncated')
+        try:
+            raw = zlib.decompress(data)
+        except zlib.error:
+            raise ValueError(f'{f.name} has a corrupt chunk')
+        if len(raw) != raw_len:
+            raise ValueError(f'{f.name} has a corrupt chunk')
+        yield raw
+
+
+def export_snapshot(store, file_name, tag=None, pattern=None, newer_than=None, level=6):
+    """
+    Writes the rows of a SqliteStore matching tag, key pattern (re.match) and newer_than (utc datetime) to
+    file_name.  In WAL mode rows are read through a separate connection, which sees a consistent snapshot without
+    blocking writers.  Otherwise they're read from a backup copy taken first, so the store is only locked while
+    the copy is made.  Returns the number of rows written.
+    """
+    tmp_file_name = f'{file_name}.tmp'
+    count = 0
+    with ExitStack() as stack:
+        if store.wal:
+            source = SqliteStore(*os.path.split(store.file_name))
+        else:
+            copy_dir = stack.enter_context(tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(file_name))))
+            store._backup(os.path.join(copy_dir, 'snapshot.db'))
+            source = SqliteStore(copy_dir, 'snapshot.db')
+        stack.callback(source.close)
+        try:
+            with open(tmp_file_name, 'wb') as f:
+                f.write(MAGIC)
+                records, size = [], 0
+                for row in source._rows(tag=tag, newer_than=newer_than, pattern=pattern):
+                    record = _pack(row)
+                    records.append(record)
+                    size += len(record)
+                    count += 1
+                    if size >= CHUNK_SIZE:
+                        _write_chunk(f, records, level)
+                        records, size = [], 0
+                if records:
+                    _write_chunk(f, records, level)
+                f.write(_chunk_header.pack(0, 0))
+        except Exception:
+            os.remove(tmp_file_name)
+            raise
+    os.replace(tmp_file_name, file_name)
+    return count
+
+
+def import_snapshot(store, file_name, replace=True):
+    """
+    Loads a snapshot into a SqliteStore.  The whole file is checked before anything is written, rows are then
+    committed one transaction per chunk.  Existing keys are kept when replace is False.
+    Returns the number of rows written.
+    """
+    count = 0
+    with open(file_name, 'rb') as f:
+        for _ in _read_chunks(f):
+            pass
+        f.seek(0)
+        for chunk in _read_chunks(f):
+            count += store._store_rows(_unpack(chunk), replace=replace)
+    return count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export or import devcache snapshots')
+    parser.add_argument('action', choices=['export', 'import'])
+    parser.add_argument('file_name')
+    parser.add_argument('--data-dir', default=os.path.join(DEFAULT_DIR, 'stash.db'))
+    parser.add_argument('--db-file-name', default=None)
+    parser.add_argument('--tag', default=None)
+    parser.add_argument('--pattern', default=None)
+    parser.add_argument('--max-age-hours', type=float, default=None)
+    parser.add_argument('--keep-existing', action='store_true')
+    parser.add_argument('--shared-memory-name', default=None)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    sqlite_store = SqliteStore(args.data_dir, args.db_file_name)
+    # imported rows replace cached values, keep a shared memory tier from serving the old ones
+    hot = attach_hot_stash(sqlite_store, args.shared_memory_name)
+    if args.action == 'export':
+        newer_than = datetime.utcnow() - timedelta(hours=args.max_age_hours) if args.max_age_hours else None
+        n = export_snapshot(sqlite_store, args.file_name, tag=args.tag, pattern=args.pattern, newer_than=newer_than)
+        logger.info(f'exported {n} items to {args.file_name}')
+    else:
+        n = import_snapshot(sqlite_store, args.file_name, replace=not args.keep_existing)
+        logger.info(f'imported {n} items from {args.file_name}')
+    sqlite_store.close()
+    if hot:
+        hot.close()
@@ -1,8 +1,17 @@
 import os
 import pickle
+import re
 import sqlite3
+import struct
+import threading
+import time
+import zlib
 from contextlib import contextmanager
 from datetime import datetime
+from functools import lru_cache
+from hashlib import md5
+
+DEFAULT_DIR = os.path.expanduser(r'~/.devcache')
 
 
 @contextmanager
@@ -35,80 +44,496 @@ class MemoryStore:
     def delete(self, key):
         self.data.pop(key)
 
+    def clear(self):
+        self.data.clear()
+
+    def invalidate(self, key=None):
+        if key is not None:
+            self.data.pop(key, None)
+        else:
+            self.data.clear()
+
+
+class SharedMemoryStore:
+    """
+    Host-local hot tier.  Pickled values live in a fixed size shared memory arena that every process on the
+    machine attaches to by name.  The arena is split into sets of ``ways`` slots, a key hashes to one set and
+    the oldest slot in the set is evicted when it's full.  Values that don't fit in a slot are not kept.
+
+    Writers bump a per slot sequence number around each write (odd while writing) and readers retry as a miss
+    when it changed, so no cross process lock is needed.  Slots written before the arena's generation was last
+    bumped by invalidate() are treated as empty.
+
+    The arena outlives the processes using it, remove it with unlink().
+    """
+
+    MAGIC = b'DVCSHM02'
+    # magic, slots, slot size, ways, generation
+    _arena_header = struct.Struct('<8sIIIQ')
+    _generation_offset = 20
+    # key digest, sequence, payload length, payload crc32, write time, generation
+    _slot_header = struct.Struct('<16sQIIdQ')
+
+    def __init__(self, name, slots=1024, slot_size=64 * 1024, ways=4, create=True):
+        # imported here so processes that never configure shared memory don't pay for multiprocessing
+        from multiprocessing import resource_tracker, shared_memory
+
+        self.name = name
+        size = self._arena_header.size + slots * slot_size
+        try:
+            if not create:
+                raise FileExistsError
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+            self._arena_header.pack_into(self.shm.buf, 0, self.MAGIC, slots, slot_size, ways, 1)
+        except FileExistsError:
+            self.shm = shared_memory.SharedMemory(name=name)
+            magic, slots, slot_size, ways, _ = self._arena_header.unpack_from(self.shm.buf, 0)
+            if magic != self.MAGIC:
+                self.shm.close()
+                raise ValueError(f'Shared memory {name} is not a devcache arena')
+        if os.name == 'posix':
+            # The arena outlives any single process, lifetime is managed with unlink()
+            resource_tracker.unregister(self.shm._name, 'shared_memory')
+        self.slots = slots
+        self.slot_size = slot_size
+        self.ways = max(1, min(ways, slots))
+        self.sets = max(1, slots // self.ways)
+
+    @property
+    def generation(self):
+        return struct.unpack_from('<Q', self.shm.buf, self._generation_offset)[0]
+
+    def _digest(self, key):
+        return md5(str(key).encode('utf-8')).digest()
+
+    def _offset(self, slot):
+        return self._arena_header.size + slot * self.slot_size
+
+    def _find(self, digest):
+        generation = self.generation
+        first = int.from_bytes(digest[:8], 'little') % self.sets * self.ways
+        free = oldest = None
+        oldest_time = None
+        for slot in range(first, first + self.ways):
+            d, seq, length, _, written, slot_generation = self._slot_header.unpack_from(self.shm.buf,
+                                                                                        self._offset(slot))
+            live = length and slot_generation == generation
+            if d == digest and live:
+                return slot, True
+            if not live and free is None:
+                free = slot
+            if oldest_time is None or written < oldest_time:
+                oldest, oldest_time = slot, written
+        return (free if free is not None else oldest), False
+
+    def _read(self, key):
+        digest = self._digest(key)
+        slot, found = self._find(digest)
+        if not found:
+            raise KeyError(f'{key} not in store')
+        offset = self._offset(slot)
+        d, seq, length, crc, _, generation = self._slot_header.unpack_from(self.shm.buf, offset)
+        start = offset + self._slot_header.size
+        payload = self.shm.buf[start:start + length]
+        try:
+            if seq % 2 or d != digest or generation != self.generation or zlib.crc32(payload) != crc:
+                raise KeyError(f'{key} not in store')
+            obj = pickle.loads(payload)
+        except KeyError:
+            raise
+        except Exception:
+            raise KeyError(f'{key} not in store')
+        finally:
+            payload.release()
+        if self._slot_header.unpack_from(self.shm.buf, offset)[1] != seq:
+            raise KeyError(f'{key} not in store')
+        return obj
+
+    def store(self, key, obj, generation=None, **kwargs):
+        """
+        Pass the ``generation`` read before fetching obj from elsewhere, so a value that was invalidated in the
+        meantime isn't brought back
+        """
+        if generation is None:
+            generation = self.generation
+        payload = pickle.dumps(obj, protocol=5)
+        if len(payload) > self.slot_size - self._slot_header.size:
+            return False
+        digest = self._digest(key)
+        slot, _ = self._find(digest)
+        offset = self._offset(slot)
+        seq = self._slot_header.unpack_from(self.shm.buf, offset)[1]
+        seq += 1 if seq % 2 == 0 else 2
+        self._slot_header.pack_into(self.shm.buf, offset, digest, seq, 0, 0, 0.0, 0)
+        start = offset + self._slot_header.size
+        self.shm.buf[start:start + len(payload)] = payload
+        self._slot_header.pack_into(self.shm.buf, offset, digest, seq + 1, len(payload), zlib.crc32(payload),
+                                    time.time(), generation)
+        return True
+
+    def get(self, key, raise_key_error=False):
+        try:
+            return self._read(key)
+        except KeyError:
+            if raise_key_error:
+                raise
+
+    def exists(self, key):
+        return self._find(self._digest(key))[1]
+
+    def delete(self, key):
+        slot, found = self._find(self._digest(key))
+        if found:
+            offset = self._offset(slot)
+            seq = self._slot_header.unpack_from(self.shm.buf, offset)[1]
+            self._slot_header.pack_into(self.shm.buf, offset, bytes(16), seq + 2 - seq % 2, 0, 0, 0.0, 0)
+
+    def invalidate(self, key=None):
+        """
+        Drops key, or everything when key is None
+        """
+        if key is not None:
+            self.delete(key)
+        else:
+            struct.pack_into('<Q', self.shm.buf, self._generation_offset, self.generation + 1)
+
+    def clear(self):
+        self.invalidate()
+
+    def close(self):
+        self.shm.close()
+
+    def unlink(self):
+        from multiprocessing import resource_tracker
+
+        if os.name == 'posix':
+            # unlink() unregisters from the resource tracker, which complains about names it never saw
+            resource_tracker.register(self.shm._name, 'shared_memory')
+        self.shm.unlink()
+
+
+def default_hot_stash_name():
+    return f'devcache_{md5(DEFAULT_DIR.encode("utf-8")).hexdigest()[:16]}'
+
+
+def attach_hot_stash(store, name=None):
+    """
+    Attaches to an existing shared memory tier so changes made to store invalidate it.  For tools that change
+    the stash without going through the decorator.  Returns None when there's no such arena.
+    """
+    name = name or default_hot_stash_name()
+    try:
+        hot = SharedMemoryStore(name, create=False)
+    except (FileNotFoundError, ValueError):
+        return None
+    store.listeners.append(hot)
+    return hot
+
+
+class TieredStore:
+    """
+    Reads go to ``hot`` first and fall back to ``cold``, populating ``hot`` on the way out.
+    Writes and deletes go to both.  When ``cold`` takes listeners, ``hot`` is also invalidated by changes made
+    directly to ``cold``.
+    """
+
+    def __init__(self, hot, cold):
+        self.hot = hot
+        self.cold = cold
+        listeners = getattr(cold, 'listeners', None)
+        if listeners is not None and hot not in listeners:
+            listeners.append(hot)
+
+    def store(self, key, obj, **kwargs):
+        self.cold.store(key, obj, **kwargs)
+        self.hot.store(key, obj)
+
+    def get(self, key, raise_key_error=False):
+        try:
+            return self.hot.get(key, raise_key_error=True)
+        except KeyError:
+            pass
+        generation = getattr(self.hot, 'generation', None)
+        try:
+            obj = self.cold.get(key, raise_key_error=True)
+        except KeyError:
+            if raise_key_error:
+                raise
+            return None
+        if generation is None:
+            self.hot.store(key, obj)
+        else:
+            self.hot.store(key, obj, generation=generation)
+        return obj
+
+    def exists(self, key):
+        return self.hot.exists(key) or self.cold.exists(key)
+
+    def delete(self, key):
+        if self.hot.exists(key):
+            self.hot.delete(key)
+        self.cold.delete(key)
+
+    def delete_by_tag(self, tag):
+        # the hot tier doesn't keep tags
+        self.hot.clear()
+        self.cold.delete_by_tag(tag)
+
+    def delete_older(self, ref_time_utc):
+        self.hot.clear()
+        self.cold.delete_older(ref_time_utc)
+
+    def clear(self):
+        self.hot.clear()
+        self.cold.clear()
+
+
+def _regexp(pattern, value):
+    return value is not None and _compiled(pattern).match(value) is not None
+
+
+@lru_cache(maxsize=64)
+def _compiled(pattern):
+    return re.compile(pattern)
+
 
 class SqliteStore:
 
+    # Applied in order on open, PRAGMA user_version records how many have run
+    migrations = [
+        ['CREATE INDEX IF NOT EXISTS data_tag ON data (tag, timestamp, key)',
+         'CREATE INDEX IF NOT EXISTS data_timestamp ON data (timestamp, key)'],
+    ]
+
     def _get_now_str(self):
         return datetime.utcnow().isoformat()
 
     def __init__(self, data_dir, db_file_name=None):
-        if not os.path.isdir(data_dir):
-            os.mkdir(data_dir)
         path = os.path.expanduser(data_dir)
+        os.makedirs(path, exist_ok=True)
         db_file_name = db_file_name or 'stash_data.db'
-        self.conn = sqlite3.connect(os.path.join(path, db_file_name))
-        with cursor(self.conn) as c:
+        self.file_name = os.path.join(path, db_file_name)
+        # shared between threads, the lock keeps them from interleaving statements and commits
+        self.conn = sqlite3.connect(self.file_name, check_same_thread=False)
+        self.lock = threading.RLock()
+        # hot tiers sitting in front of this store, invalidated whenever rows change
+        self.listeners = []
+        self.conn.create_function('regexp', 2, _regexp, deterministic=True)
+        with self._cursor() as c:
             c.execute('''CREATE TABLE IF NOT EXISTS data
              (key TEXT PRIMARY KEY, tag TEXT, value TEXT, timestamp TEXT)''')
+        self._migrate()
+        self.wal = self._enable_wal()
+
+    def _enable_wal(self):
+        """
+        Switches the database to write-ahead logging, where readers see a consistent snapshot without blocking
+        writers.  Stays in the old mode where that isn't possible (e.g. some network filesystems).
+        """
+        try:
+            with self._cursor() as c:
+                return c.execute('PRAGMA journal_mode = WAL').fetchone()[0].lower() == 'wal'
+        except sqlite3.OperationalError:
+            return False
+
+    def _changed(self, key=None):
+        for listener in self.listeners:
+            listener.invalidate(key)
+
+    @contextmanager
+    def _cursor(self):
+        with self.lock, cursor(self.conn) as c:
+            yield c
+
+    def _migrate(self):
+        with self._cursor() as c:
+            version = c.execute('PRAGMA user_version').fetchone()[0]
+            for index, statements in enumerate(self.migrations[version:], start=version + 1):
+                for statement in statements:
+                    c.execute(statement)
+                c.execute(f'PRAGMA user_version = {index}')
 
     def store(self, key, obj, tag=None):
-        obj_pickle = pickle.dumps(obj)
-        with cursor(self.conn) as c:
-            data = (str(key), str(tag), obj_pickle, self._get_now_str())
-            c.execute('REPLACE INTO DATA VALUES (?, ?, ?, ?)', data)
+        self._store_raw(key, pickle.dumps(obj), tag=tag)
 
     def get(self, key, raise_key_error=False):
+        try:
+            value = self._get_raw(key)
+        except KeyError:
+            if raise_key_error:
+                raise
+            return None
+        return pickle.loads(value)
+
+    def _store_raw(self, key, value, tag=None):
+        """
+        Stores value, which is already pickled
+        """
+        with self._cursor() as c:
+            data = (str(key), str(tag), value, self._get_now_str())
+            c.execute('REPLACE INTO DATA VALUES (?, ?, ?, ?)', data)
+        self._changed(key)
+
+    def _get_raw(self, key):
+        """
+        The stored pickled bytes for key
+        """
         key = str(key)
-        with cursor(self.conn) as c:
-            data = c.execute('SELECT value FROM data WHERE key = ?', (key,))
-            o = data.fetchone()
-            if raise_key_error and not o:
-                raise KeyError(f'{key} not in store')
-            elif o:
-                return pickle.loads(o[0])
+        with self._cursor() as c:
+            o = c.execute('SELECT value FROM data WHERE key = ?', (key,)).fetchone()
+        if not o:
+            raise KeyError(f'{key} not in store')
+        return o[0]
 
     def exists(self, key):
-        with cursor(self.conn) as c:
+        with self._cursor() as c:
             data = c.execute('SELECT EXISTS(SELECT 1 FROM data WHERE key=?)', (key,))
             v = data.fetchone()[0]
         return v
 
-    def ls(self, tag=None):
-        for index, item in enumerate(self._ls(tag=tag)):
-            print(f'{index}: {item}')
+    def ls(self, tag=None, pattern=None, limit=None):
+        for index, (key, _, _, _) in enumerate(self._iter_ls(tag=tag, pattern=pattern, limit=limit)):
+            print(f'{index}: {key}')
 
     def delete(self, key):
         key = str(key)
-        with cursor(self.conn) as c:
+        with self._cursor() as c:
             c.execute(f'DELETE FROM data WHERE key = ?', (key,))
+        self._changed(key)
 
     def delete_by_index(self, index):
-        items = self._ls()
-        if index < len(items):
-            self.delete(items[index])
+        with self._cursor() as c:
+            o = c.execute('SELECT key FROM data ORDER BY timestamp, key LIMIT 1 OFFSET ?', (index,)).fetchone()
+        if o:
+            self.delete(o[0])
 
     def delete_by_tag(self, tag):
-        with cursor(self.conn) as c:
+        with self._cursor() as c:
             c.execute(f'DELETE FROM data WHERE tag = ?', (tag,))
+        self._changed()
 
     def delete_older(self, ref_time_utc):
-        with cursor(self.conn) as c:
+        with self._cursor() as c:
             c.execute('DELETE FROM data WHERE timestamp < ?', (ref_time_utc.isoformat(),))
+        self._changed()
+
+    def purge(self, tag=None, older_than=None, pattern=None):
+        """
+        Deletes items matching all of tag, older_than (utc datetime) and key pattern (re.match).
+        Returns the number deleted.
+        """
+        if not (tag or older_than or pattern):
+            raise ValueError('purge needs a tag, older_than or pattern, use clear to delete everything')
+        where, params = self._where(tag=tag, older_than=older_than, pattern=pattern)
+        with self._cursor() as c:
+            c.execute(f'DELETE FROM data{where}', params)
+            deleted = c.rowcount
+        self._changed()
+        return deleted
 
     def clear(self):
-        with cursor(self.conn) as c:
+        with self._cursor() as c:
             c.execute('DELETE FROM data')
+        self._changed()
+
+    def stats(self):
+        """
+        Returns {tag: {'count', 'size', 'oldest', 'newest'}}, size is bytes of stored values
+        """
+        result = {}
+        with self._cursor() as c:
+            data = c.execute('SELECT tag, COUNT(*), SUM(LENGTH(value)), MIN(timestamp), MAX(timestamp) '
+                             'FROM data GROUP BY tag')
+            for tag, count, size, oldest, newest in data:
+                result[tag] = {'count': count, 'size': size or 0, 'oldest': oldest, 'newest': newest}
+        return result
+
+    def _where(self, tag=None, newer_than=None, older_than=None, pattern=None):
+        clauses, params = [], []
+        if tag:
+            clauses.append('tag = ?')
+            params.append(tag)
+        if newer_than:
+            clauses.append('timestamp >= ?')
+            params.append(newer_than.isoformat())
+        if older_than:
+            clauses.append('timestamp < ?')
+            params.append(older_than.isoformat())
+        if pattern:
+            try:
+                _compiled(pattern)
+            except re.error as e:
+                raise ValueError(f'Invalid pattern {pattern}: {e}')
+            clauses.append('key REGEXP ?')
+            params.append(pattern)
+        return (f' WHERE {" AND ".join(clauses)}' if clauses else ''), params
+
+    def _ls_page(self, tag=None, pattern=None, after=None, limit=1000):
+        """
+        One page of (key, tag, timestamp, size) ordered by (timestamp, key), starting after the
+        (timestamp, key) of the last row of the previous page
+        """
+        where, params = self._where(tag=tag, pattern=pattern)
+        if after:
+            where += ' AND ' if where else ' WHERE '
+            where += 'timestamp >= ? AND (timestamp > ? OR key > ?)'
+            params += [after[0], after[0], after[1]]
+        with self._cursor() as c:
+            data = c.execute(f'SELECT key, tag, timestamp, LENGTH(value) FROM data{where} '
+                             f'ORDER BY timestamp, key LIMIT ?', params + [limit])
+            return data.fetchall()
+
+    def _iter_ls(self, tag=None, pattern=None, limit=None, page_size=1000):
+        if page_size < 1:
+            raise ValueError(f'page_size must be at least 1, got {page_size}')
+        after = None
+        count = 0
+        while limit is None or count < limit:
+            size = page_size if limit is None else min(page_size, limit - count)
+            page = self._ls_page(tag=tag, pattern=pattern, after=after, limit=size)
+            yield from page
+            count += len(page)
+            if len(page) < size:
+                break
+            after = (page[-1][2], page[-1][0])
 
     def _ls(self, tag=None):
-        items = []
-        with cursor(self.conn) as c:
-            sql = 'SELECT key FROM data ORDER BY timestamp ASC'
-            if tag:
-                sql += ' WHERE tag = ?'
-            data = c.execute(sql) if not tag else c.execute(sql, (tag,))
-            for index, name in enumerate(data):
-                items.append(name[0])
-        return items
+        return [key for key, _, _, _ in self._iter_ls(tag=tag)]
+
+    def _backup(self, file_name):
+        """
+        Consistent copy of the database at file_name, using sqlite's online backup
+        """
+        target = sqlite3.connect(file_name)
+        try:
+            with self.lock:
+                self.conn.backup(target)
+        finally:
+            target.close()
+
+    def _rows(self, tag=None, newer_than=None, pattern=None, chunk_size=1000):
+        """
+        Yields raw (key, tag, value, timestamp) rows from a single statement.  The store's lock and sqlite's read
+        lock are held until it's exhausted, so use it on a private connection (see _backup) rather than a live
+        store.
+        """
+        where, params = self._where(tag=tag, newer_than=newer_than, pattern=pattern)
+        sql = f'SELECT key, tag, value, timestamp FROM data{where}'
+        with self._cursor() as c:
+            data = c.execute(sql, params)
+            while True:
+                rows = data.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield from rows
+
+    def _store_rows(self, rows, replace=True):
+        verb = 'REPLACE' if replace else 'INSERT OR IGNORE'
+        with self._cursor() as c:
+            c.executemany(f'{verb} INTO data VALUES (?, ?, ?, ?)', rows)
+            count = c.rowcount
+        self._changed()
+        return count
 
     def close(self):
         self.conn.close()
@@ -12,7 +12,6 @@ def read(fname):
 with pathlib.Path('requirements.txt').open() as requirements_txt:
     install_requires = [str(requirement).strip() for requirement in pkg_resources.parse_requirements(requirements_txt)
                         if not str(requirement).strip().startswith('#')]
-print(find_packages('src'))
 setup(
     name='devcache',
     version='1.0.2',
@@ -22,8 +21,8 @@ setup(
     license='MIT',
     url='https://github.com/pcauthorn/devcache',
     install_requires=install_requires,
-    package_dir={'': str('src')},
-    packages=find_packages('src'),
+    packages=find_packages(include=['devcache', 'devcache.*']),
+    entry_points={'console_scripts': ['devcache=devcache.__main__:main']},
     long_description=read('README.md'),
     long_description_content_type='text/markdown',
     classifiers=[
@@ -1,11 +1,17 @@
+import os
+import socket
+import subprocess
+import sys
+import tempfile
 import unittest
+import uuid
 from copy import deepcopy
 from io import StringIO
 from unittest import mock
 from unittest.mock import create_autospec
 from unittest.mock import patch
 from devcache import devcache
-from devcache.cache import _get_function_arg_str
+from devcache.cache import _get_function_arg_str, _load_config_file, _resolve_props, hot_stashes, remote_stashes
 from devcache.storage import MemoryStore
 from devcache.utils import update_dicts
 
@@ -210,6 +216,82 @@ props:
         decorated('hello')
         self.assertEqual(self.mock.call_count, 1)
 
+    def test_shared_memory(self):
+        name = f'devcache_test_{uuid.uuid4().hex[:12]}'
+        f = StringIO(f'''
+shared_memory:
+    name: {name}
+    slots: 8
+    slot_size: 1024
+props:
+    1:
+        group: one
+        use_cache: true
+                        ''')
+        decorated = devcache(config_file=f, group='one')(self.mock)
+        self.mock.return_value = 3
+        decorated('hello')
+        self.store.data.clear()
+        self.assertEqual(decorated('hello'), 3)
+        self.mock.assert_called_once()
+        hot = hot_stashes.pop(name)
+        hot.close()
+        hot.unlink()
+
+    def test_server_down(self):
+        with socket.socket() as s:
+            s.bind(('localhost', 0))
+            port = s.getsockname()[1]
+        f = StringIO(f'''
+server: localhost:{port}
+props:
+    1:
+        group: one
+        use_cache: true
+                        ''')
+        decorated = devcache(config_file=f, group='one')(self.mock)
+        self.mock.return_value = 3
+        self.assertEqual(decorated('hello'), 3)
+        self.assertEqual(decorated('hello'), 3)
+        self.assertEqual(self.mock.call_count, 2)
+        remote_stashes.pop(f'localhost:{port}').close()
+
+    def test_shared_memory_with_server(self):
+        name = f'devcache_test_{uuid.uuid4().hex[:12]}'
+        f = StringIO(f'''
+server: localhost:1
+shared_memory:
+    name: {name}
+    slots: 8
+    slot_size: 1024
+props:
+    1:
+        group: one
+        use_cache: true
+                        ''')
+        with self.assertLogs('devcache.cache', 'WARNING') as logs:
+            devcache(config_file=f, group='one')(self.mock)
+        self.assertIn('not invalidated', logs.output[0])
+        remote_stashes.pop('localhost:1').close()
+        hot = hot_stashes.pop(name)
+        hot.close()
+        hot.unlink()
+
+    def test_stash_patched_after_decorating(self):
+        f = StringIO('''
+props:
+    1:
+        group: one
+        use_cache: true
+                        ''')
+        decorated = devcache(config_file=f, group='one')(self.mock)
+        self.mock.return_value = 3
+        other = MemoryStore()
+        with mock.patch('devcache.cache.stash', other):
+            decorated('hello')
+        self.assertEqual(len(other.data), 1)
+        self.assertEqual(self.store.data, {})
+
     def test_key_prefix(self):
         f = StringIO('''
 key_prefix: 'yo'
@@ -302,5 +384,69 @@ props:
         self.assertEqual(mock_function.call_count, 2)
 
 
+class TestConfigSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.snapshot_dir = mock.patch('devcache.cache.CONFIG_SNAPSHOT_DIR', os.path.join(self.temp_dir.name, 's'))
+        self.snapshot_dir.start()
+        self.config_file = os.path.join(self.temp_dir.name, 'devcache.yaml')
+        self.write_config('crm')
+
+    def tearDown(self):
+        self.snapshot_dir.stop()
+        self.temp_dir.cleanup()
+
+    def write_config(self, group):
+        with open(self.config_file, 'w') as f:
+            f.write(f"""
+props:
+    0:
+        pattern: '.*sfdc.*'
+        use_cache: false
+    1:
+        group: {group}
+        use_cache: true
+""")
+
+    def test_snapshot_reused(self):
+        config, rules = _load_config_file(self.config_file)
+        self.assertEqual(_resolve_props(config, 'crm', 'a.b', rules)['use_cache'], True)
+        self.assertNotIn('_rules', config)
+        with patch('yaml.safe_load') as safe_load:
+            self.assertEqual(_load_config_file(self.config_file), (config, rules))
+            safe_load.assert_not_called()
+
+    def test_snapshot_refreshed(self):
+        _load_config_file(self.config_file)
+        stat = os.stat(self.config_file)
+        self.write_config('db')
+        os.utime(self.config_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        config, rules = _load_config_file(self.config_file)
+        self.assertEqual(_resolve_props(config, 'crm', 'a.b', rules), {})
+        self.assertEqual(_resolve_props(config, 'db', 'a.b', rules)['group'], 'db')
+
+    def test_patterns(self):
+        config, rules = _load_config_file(self.config_file)
+        self.assertEqual(_resolve_props(config, 'crm', 'my.sfdc.get', rules)['use_cache'], False)
+
+    def test_bad_rules_skipped(self):
+        config = {'props': {0: {'pattern': '(', 'use_cache': False},
+                            1: {'group': 'crm', 'extra': 1},
+                            2: {'group': 'crm', 'enabled': False},
+                            3: {'group': 'crm', 'use_cache': True}}}
+        self.assertEqual(_resolve_props(config, 'crm', '(')['use_cache'], True)
+
+
+class TestImports(unittest.TestCase):
+
+    def test_lazy_imports(self):
+        code = ('import sys, devcache; '
+                'print([m for m in ("yaml", "devcache.remote", "multiprocessing.shared_memory") if m in sys.modules])')
+        out = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.dirname(__file__)),
+                             capture_output=True, text=True, check=True)
+        self.assertEqual(out.stdout.strip(), '[]')
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,77 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+import uuid
+from contextlib import redirect_stderr, redirect_stdout
+from io import StringIO
+
+from devcache.__main__ import main
+from devcache.storage import SharedMemoryStore, SqliteStore
+
+
+class TestCli(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.store = SqliteStore(self.temp_dir.name)
+        for i in range(5):
+            self.store.store(f'crm.{i}', i, tag='crm')
+        self.store.store('db.0', 0, tag='db')
+
+    def tearDown(self):
+        self.store.close()
+        self.temp_dir.cleanup()
+
+    def run_main(self, *args):
+        out = StringIO()
+        with redirect_stdout(out):
+            main(['--data-dir', self.temp_dir.name] + list(args))
+        return out.getvalue().splitlines()
+
+    def test_ls(self):
+        self.assertEqual(len(self.run_main('ls')), 6)
+        self.assertEqual(len(self.run_main('ls', '--tag', 'crm', '--limit', '3', '--page-size', '2')), 3)
+        self.assertTrue(self.run_main('ls', '--pattern', 'db')[0].startswith('0: db.0'))
+
+    def test_bad_args(self):
+        for args in [('ls', '--pattern', '('), ('purge', '--pattern', '('), ('ls', '--page-size', '0')]:
+            with redirect_stderr(StringIO()):
+                self.assertRaises(SystemExit, self.run_main, *args)
+        self.assertEqual(len(self.store._ls()), 6)
+
+    def test_stats(self):
+        lines = self.run_main('stats')
+        self.assertTrue(lines[1].startswith('crm\t5\t'))
+        self.assertTrue(lines[-1].startswith('total\t6\t'))
+
+    def test_fresh_machine(self):
+        home = os.path.join(self.temp_dir.name, 'home')
+        os.mkdir(home)
+        env = dict(os.environ, HOME=home, USERPROFILE=home)
+        out = subprocess.run([sys.executable, '-m', 'devcache', '--data-dir', self.temp_dir.name, 'stats'], env=env,
+                             cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))), check=True,
+                             capture_output=True, text=True)
+        self.assertTrue(out.stdout.splitlines()[-1].startswith('total\t6\t'))
+
+    def test_purge(self):
+        self.assertEqual(self.run_main('purge', '--tag', 'crm'), ['deleted 5'])
+        self.assertEqual(self.store._ls(), ['db.0'])
+        self.assertRaises(SystemExit, self.run_main, 'purge')
+        self.run_main('purge', '--all')
+        self.assertEqual(self.store._ls(), [])
+
+    def test_purge_shared_memory(self):
+        name = f'devcache_test_{uuid.uuid4().hex[:12]}'
+        hot = SharedMemoryStore(name, slots=8, slot_size=1024)
+        hot.store('crm.0', 0)
+        self.run_main('--shared-memory-name', name, 'purge', '--tag', 'crm')
+        self.assertFalse(hot.exists('crm.0'))
+        hot.close()
+        self.assertEqual(self.run_main('--shared-memory-name', name, 'purge', '--shared-memory'),
+                         [f'removed shared memory: {name}'])
+        self.assertRaises(FileNotFoundError, SharedMemoryStore, name, create=False)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,158 @@
+import json
+import os
+import socket
+import struct
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from datetime import datetime, timedelta
+
+from devcache.remote import MAX_HEADER_SIZE, MAX_VALUE_SIZE, CacheServer, RemoteStore
+from devcache.storage import SqliteStore
+
+
+class PickleMe:
+    def __init__(self, v):
+        self.v = v
+
+    def __eq__(self, other):
+        return self.v == other.v
+
+
+class TestRemoteStore(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.backing = SqliteStore(self.temp_dir.name)
+        self.server = CacheServer(self.backing, 'localhost:0').start()
+        self.store = RemoteStore(self.server.address)
+
+    def tearDown(self):
+        self.store.close()
+        self.server.stop()
+        self.backing.close()
+        self.temp_dir.cleanup()
+
+    def test_store_and_get(self):
+        self.store.store('k1', 'one')
+        self.store.store('k2', None)
+        self.store.store('k3', PickleMe(3))
+        self.assertEqual(self.store.get('k1'), 'one')
+        self.assertIsNone(self.store.get('k2'))
+        self.assertEqual(self.store.get('k3'), PickleMe(3))
+        self.assertRaises(KeyError, self.store.get, 'nok', raise_key_error=True)
+        self.assertIsNone(self.store.get('nok'))
+
+    def test_exists_and_delete(self):
+        self.store.store('iam', 'i')
+        self.assertTrue(self.store.exists('iam'))
+        self.assertFalse(self.store.exists('iamnot'))
+        self.store.delete('iam')
+        self.assertFalse(self.store.exists('iam'))
+
+    def test_delete_by_tag(self):
+        self.store.store(1, 1, tag='a')
+        self.store.store('h', 'hello', tag='b')
+        self.store.delete_by_tag('a')
+        self.assertEqual(self.backing._ls(), ['h'])
+
+    def test_delete_older_and_clear(self):
+        self.store.store(1, 1)
+        self.store.delete_older(datetime.utcnow() - timedelta(minutes=1))
+        self.assertTrue(self.store.exists(1))
+        self.store.delete_older(datetime.utcnow() + timedelta(minutes=1))
+        self.assertFalse(self.store.exists(1))
+        self.store.store(2, 2)
+        self.store.clear()
+        self.assertEqual(self.backing._ls(), [])
+
+    def test_bulk(self):
+        items = {i: i * 2 for i in range(200)}
+        self.store.store_many(items, tag='bulk')
+        self.assertEqual(self.store.get_many(list(items) + ['nok']), items)
+        self.store.delete_many(range(100))
+        self.assertEqual(len(self.store.get_many(items)), 100)
+
+    def test_large_value(self):
+        value = os.urandom(5 * 1024 * 1024)
+        self.store.store('big', value)
+        self.assertEqual(self.store.get('big'), value)
+
+    def test_threads(self):
+        def work(n):
+            for i in range(20):
+                self.store.store(f'{n}.{i}', i)
+                self.assertEqual(self.store.get(f'{n}.{i}'), i)
+
+        threads = [threading.Thread(target=work, args=(n,)) for n in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(self.backing._ls()), 160)
+
+    def test_server_restart(self):
+        self.store.store('k1', 1)
+        address = self.server.address
+        self.server.stop()
+        self.server = CacheServer(self.backing, address).start()
+        self.assertEqual(self.store.get('k1'), 1)
+
+    def test_server_down(self):
+        address = self.server.address
+        self.server.stop()
+        self.store.close()
+        self.assertRaises(ConnectionError, self.store.get, 'k1')
+        with mock.patch.object(self.store, '_connect', side_effect=AssertionError('should skip the server')):
+            self.assertRaises(ConnectionError, self.store.store, 'k1', 1)
+        self.server = CacheServer(self.backing, address).start()
+        self.store.down_until = 0
+        self.store.store('k1', 1)
+        self.assertEqual(self.store.get('k1'), 1)
+
+    def test_oversized_frames(self):
+        for frame in [struct.pack('!Q', 2 ** 62), struct.pack('!Q', MAX_HEADER_SIZE + 1) + b'{}']:
+            with socket.create_connection(self.store.address) as sock:
+                sock.sendall(frame)
+                self.assertEqual(sock.recv(1), b'')
+        with socket.create_connection(self.store.address) as sock:
+            header = json.dumps({'op': 'store', 'key': 'k'}).encode('utf-8')
+            sock.sendall(struct.pack('!Q', len(header)) + header + struct.pack('!Q', MAX_VALUE_SIZE + 1))
+            self.assertEqual(sock.recv(1), b'')
+        self.store.store('k1', 1)
+        self.assertEqual(self.store.get('k1'), 1)
+
+    def test_errors(self):
+        self.assertRaises(RuntimeError, self.store._call, 'nop')
+        self.store.store('k1', 1)
+        self.assertEqual(self.store.get('k1'), 1)
+
+    def test_same_format_as_local(self):
+        self.store.store('remote', PickleMe(1), tag='a')
+        self.assertEqual(self.backing.get('remote'), PickleMe(1))
+        self.backing.store('local', b'raw bytes')
+        self.assertEqual(self.store.get('local'), b'raw bytes')
+        self.assertEqual(self.backing.stats()['a']['count'], 1)
+
+
+@unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'unix sockets')
+class TestRemoteStoreUnixSocket(unittest.TestCase):
+
+    def test_store_and_get(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            backing = SqliteStore(temp_dir)
+            server = CacheServer(backing, os.path.join(temp_dir, 'devcache.sock')).start()
+            store = RemoteStore(server.address)
+            store.store('k1', [1, 2])
+            self.assertEqual(store.get('k1'), [1, 2])
+            store.close()
+            server.stop()
+            backing.close()
+
+    def test_not_supported(self):
+        with mock.patch('devcache.remote._UnixServer', None):
+            self.assertRaises(ValueError, CacheServer, None, '/tmp/devcache.sock')
+
+
+if __name__ == '__main__':
+    unittest.main()
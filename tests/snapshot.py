@@ -0,0 +1,129 @@
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+from devcache import snapshot
+from devcache.snapshot import export_snapshot, import_snapshot
+from devcache.storage import SqliteStore
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.source = SqliteStore(self.temp_dir.name, 'source.db')
+        self.target = SqliteStore(self.temp_dir.name, 'target.db')
+        self.file_name = os.path.join(self.temp_dir.name, 'snapshot.dvc')
+
+    def tearDown(self):
+        self.source.close()
+        self.target.close()
+        self.temp_dir.cleanup()
+
+    def test_round_trip(self):
+        self.source.store('k1', {'a': 1}, tag='a')
+        self.source.store('k2', None)
+        self.source.store('k3', 'ü' * 10, tag='b')
+        self.assertEqual(export_snapshot(self.source, self.file_name), 3)
+        self.assertEqual(import_snapshot(self.target, self.file_name), 3)
+        self.assertEqual(sorted(self.target._rows()), sorted(self.source._rows()))
+        self.assertEqual(self.target.get('k1'), {'a': 1})
+
+    def test_filters(self):
+        self.source.store('crm.one', 1, tag='a')
+        self.source.store('crm.two', 2, tag='b')
+        self.source.store('db.one', 3, tag='a')
+        self.assertEqual(export_snapshot(self.source, self.file_name, tag='a'), 2)
+        self.assertEqual(export_snapshot(self.source, self.file_name, pattern=r'crm\.'), 2)
+        self.assertEqual(export_snapshot(self.source, self.file_name, tag='a', pattern=r'crm\.'), 1)
+        import_snapshot(self.target, self.file_name)
+        self.assertEqual(self.target._ls(), ['crm.one'])
+
+    def test_newer_than(self):
+        old = datetime.utcnow() - timedelta(hours=2)
+        with patch.object(SqliteStore, '_get_now_str', new=lambda x: old.isoformat()):
+            self.source.store(1, 1)
+        self.source.store(2, 2)
+        self.assertEqual(export_snapshot(self.source, self.file_name, newer_than=old + timedelta(hours=1)), 1)
+
+    def test_keep_existing(self):
+        self.source.store('k1', 'new')
+        self.target.store('k1', 'old')
+        export_snapshot(self.source, self.file_name)
+        import_snapshot(self.target, self.file_name, replace=False)
+        self.assertEqual(self.target.get('k1'), 'old')
+        import_snapshot(self.target, self.file_name)
+        self.assertEqual(self.target.get('k1'), 'new')
+
+    def test_chunks(self):
+        for i in range(50):
+            self.source.store(i, os.urandom(1024))
+        with patch.object(snapshot, 'CHUNK_SIZE', 4096):
+            export_snapshot(self.source, self.file_name)
+        self.assertEqual(import_snapshot(self.target, self.file_name), 50)
+        self.assertEqual(self.target.get(49), self.source.get(49))
+
+    def test_import_on_fresh_machine(self):
+        self.source.store('k1', 1)
+        export_snapshot(self.source, self.file_name)
+        home = os.path.join(self.temp_dir.name, 'home')
+        os.mkdir(home)
+        env = dict(os.environ, HOME=home, USERPROFILE=home)
+        subprocess.run([sys.executable, '-m', 'devcache.snapshot', 'import', self.file_name], env=env, check=True,
+                       cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))), capture_output=True)
+        store = SqliteStore(os.path.join(home, '.devcache', 'stash.db'))
+        self.assertEqual(store.get('k1'), 1)
+        store.close()
+
+    def test_bad_file(self):
+        with open(self.file_name, 'wb') as f:
+            f.write(b'not a snapshot')
+        self.assertRaises(ValueError, import_snapshot, self.target, self.file_name)
+        self.source.store('k1', 1)
+        export_snapshot(self.source, self.file_name)
+        with open(self.file_name, 'rb+') as f:
+            f.truncate(os.path.getsize(self.file_name) - 4)
+        self.assertRaises(ValueError, import_snapshot, self.target, self.file_name)
+
+    def test_truncated_chunk(self):
+        for i in range(50):
+            self.source.store(i, os.urandom(1024))
+        with patch.object(snapshot, 'CHUNK_SIZE', 4096):
+            export_snapshot(self.source, self.file_name)
+        with open(self.file_name, 'rb+') as f:
+            f.truncate(os.path.getsize(self.file_name) // 2)
+        self.assertRaises(ValueError, import_snapshot, self.target, self.file_name)
+        self.assertEqual(self.target._ls(), [])
+
+    def test_writers_not_blocked(self):
+        self.assertTrue(self.source.wal)
+        self.source._store_rows((str(i), 'None', b'0', '') for i in range(2999))
+        writer = sqlite3.connect(os.path.join(self.temp_dir.name, 'source.db'), timeout=0)
+        write_chunk = snapshot._write_chunk
+
+        def write_while_exporting(*args):
+            writer.execute("REPLACE INTO data VALUES ('k2', 'None', x'00', '')")
+            writer.commit()
+            write_chunk(*args)
+
+        for wal in [True, False]:
+            with self.subTest(wal=wal), patch.object(self.source, 'wal', wal), \
+                    patch.object(snapshot, '_write_chunk', write_while_exporting), \
+                    patch.object(snapshot, 'CHUNK_SIZE', 1024):
+                self.assertIn(export_snapshot(self.source, self.file_name), [2999, 3000])
+        writer.close()
+        self.assertTrue(self.source.exists('k2'))
+        self.assertEqual(len(self.source._ls()), 3000)
+
+    def test_wal_export_skips_backup(self):
+        self.source.store('crm.one', 1)
+        with patch.object(self.source, '_backup', side_effect=AssertionError('no backup in wal mode')):
+            self.assertEqual(export_snapshot(self.source, self.file_name, pattern=r'crm\.'), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,12 @@
+import multiprocessing
 import tempfile
+import threading
 import unittest
+import uuid
 from datetime import date, datetime, timedelta
 from unittest.mock import patch
 
-from devcache.storage import SqliteStore
+from devcache.storage import MemoryStore, SharedMemoryStore, SqliteStore, TieredStore
 
 
 class PickleMe:
@@ -105,6 +108,212 @@ class TestSqliteStore(unittest.TestCase):
         self.store.delete_by_tag('a')
         self.assertEqual(self.store._ls(), ['h', 'i'])
 
+    def test_ls_by_tag(self):
+        self.store.store(1, 1, tag='a')
+        self.store.store(2, 2, tag='b')
+        self.store.store(3, 3, tag='a')
+        self.assertEqual(self.store._ls(tag='a'), ['1', '3'])
+
+    def test_ls_pages(self):
+        now = datetime.utcnow().isoformat()
+        with patch.object(SqliteStore, '_get_now_str', new=lambda x: now):
+            for i in range(25):
+                self.store.store(f'{i:02}', i)
+        keys = [key for key, _, _, _ in self.store._iter_ls(page_size=4)]
+        self.assertEqual(keys, [f'{i:02}' for i in range(25)])
+        self.assertEqual(len(list(self.store._iter_ls(limit=10, page_size=4))), 10)
+        self.assertEqual([k for k, _, _, _ in self.store._iter_ls(pattern='1')], [f'1{i}' for i in range(10)])
+        self.assertRaises(ValueError, list, self.store._iter_ls(pattern='('))
+        self.assertRaises(ValueError, list, self.store._iter_ls(page_size=0))
+
+    def test_migrated(self):
+        indexes = {x[0] for x in self.store.conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+        self.assertTrue({'data_tag', 'data_timestamp'} <= indexes)
+        self.assertEqual(self.store.conn.execute('PRAGMA user_version').fetchone()[0], len(SqliteStore.migrations))
+        self.store.store('k1', 1)
+        self.store.close()
+        self.store = SqliteStore(self.temp_dir.name)
+        self.assertEqual(self.store.get('k1'), 1)
+
+    def test_stats(self):
+        self.store.store(1, 'x', tag='a')
+        self.store.store(2, 'y', tag='a')
+        self.store.store(3, 'z')
+        stats = self.store.stats()
+        self.assertEqual(stats['a']['count'], 2)
+        self.assertEqual(stats['None']['count'], 1)
+        self.assertGreater(stats['a']['size'], stats['None']['size'])
+
+    def test_purge(self):
+        old = datetime.utcnow() - timedelta(hours=2)
+        with patch.object(SqliteStore, '_get_now_str', new=lambda x: old.isoformat()):
+            self.store.store('crm.one', 1, tag='a')
+            self.store.store('db.one', 1, tag='a')
+        self.store.store('crm.two', 2, tag='a')
+        self.store.store('crm.three', 3, tag='b')
+        self.assertRaises(ValueError, self.store.purge)
+        self.assertEqual(self.store.purge(tag='a', pattern=r'crm\.'), 2)
+        self.assertEqual(self.store.purge(older_than=datetime.utcnow() - timedelta(hours=1)), 1)
+        self.assertEqual(self.store._ls(), ['crm.three'])
+
+    def test_threads(self):
+        errors = []
+
+        def work(n):
+            try:
+                for i in range(50):
+                    self.store.store(f'{n}.{i}', i, tag=str(n))
+                    self.assertEqual(self.store.get(f'{n}.{i}'), i)
+                    self.assertTrue(self.store.exists(f'{n}.{i}'))
+                self.store.delete_by_tag(str(n))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=work, args=(n,)) for n in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(self.store._ls(), [])
+
+
+def read_shared(name, key, queue):
+    store = SharedMemoryStore(name)
+    queue.put(store.get(key))
+    store.close()
+
+
+class TestSharedMemoryStore(unittest.TestCase):
+    def setUp(self):
+        self.name = f'devcache_test_{uuid.uuid4().hex[:12]}'
+        self.store = SharedMemoryStore(self.name, slots=8, slot_size=1024, ways=2)
+
+    def tearDown(self):
+        self.store.close()
+        self.store.unlink()
+
+    def test_store_and_get(self):
+        self.store.store('k1', 'one')
+        self.store.store('k2', PickleMe(2))
+        self.assertEqual(self.store.get('k1'), 'one')
+        self.assertEqual(self.store.get('k2'), PickleMe(2))
+        self.assertIsNone(self.store.get('nok'))
+        self.assertRaises(KeyError, self.store.get, 'nok', raise_key_error=True)
+
+    def test_exists_and_delete(self):
+        self.store.store('iam', 'i')
+        self.assertTrue(self.store.exists('iam'))
+        self.assertFalse(self.store.exists('iamnot'))
+        self.store.delete('iam')
+        self.assertFalse(self.store.exists('iam'))
+        self.store.delete('iamnot')
+
+    def test_too_large(self):
+        self.assertFalse(self.store.store('big', 'x' * 2048))
+        self.assertFalse(self.store.exists('big'))
+
+    def test_bounded(self):
+        for i in range(100):
+            self.store.store(i, i)
+        kept = [i for i in range(100) if self.store.exists(i)]
+        self.assertLessEqual(len(kept), 8)
+        self.assertIn(99, kept)
+        for i in kept:
+            self.assertEqual(self.store.get(i), i)
+
+    def test_clear(self):
+        self.store.store('k1', 1)
+        self.store.clear()
+        self.assertFalse(self.store.exists('k1'))
+
+    def test_invalidate(self):
+        self.store.store('k1', 1)
+        self.store.store('k2', 2)
+        self.store.invalidate('k1')
+        self.assertFalse(self.store.exists('k1'))
+        self.assertTrue(self.store.exists('k2'))
+        self.store.invalidate()
+        self.assertFalse(self.store.exists('k2'))
+        self.store.store('k2', 3)
+        self.assertEqual(self.store.get('k2'), 3)
+
+    def test_stale_generation(self):
+        generation = self.store.generation
+        self.store.invalidate()
+        self.store.store('k1', 'old', generation=generation)
+        self.assertFalse(self.store.exists('k1'))
+
+    def test_attach_only(self):
+        self.assertRaises(FileNotFoundError, SharedMemoryStore, f'devcache_test_{uuid.uuid4().hex[:12]}',
+                          create=False)
+
+    def test_attach(self):
+        other = SharedMemoryStore(self.name)
+        self.store.store('k1', [1, 2])
+        self.assertEqual(other.get('k1'), [1, 2])
+        self.assertEqual(other.slot_size, 1024)
+        other.close()
+
+    def test_other_process(self):
+        self.store.store('k1', {'a': 1})
+        queue = multiprocessing.Queue()
+        p = multiprocessing.Process(target=read_shared, args=(self.name, 'k1', queue))
+        p.start()
+        self.assertEqual(queue.get(timeout=30), {'a': 1})
+        p.join()
+
+
+class TestTieredStore(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.cold = SqliteStore(self.temp_dir.name)
+        self.hot = MemoryStore()
+        self.store = TieredStore(self.hot, self.cold)
+
+    def tearDown(self):
+        self.cold.close()
+        self.temp_dir.cleanup()
+
+    def test_store_and_get(self):
+        self.store.store('k1', 1, tag='a')
+        self.assertEqual(self.hot.get('k1'), 1)
+        self.assertEqual(self.cold.get('k1'), 1)
+        self.assertEqual(self.store.get('k1'), 1)
+        self.assertIsNone(self.store.get('nok'))
+        self.assertRaises(KeyError, self.store.get, 'nok', raise_key_error=True)
+
+    def test_populates_hot(self):
+        self.cold.store('k1', 'one')
+        self.assertFalse(self.hot.exists('k1'))
+        self.assertEqual(self.store.get('k1'), 'one')
+        self.assertTrue(self.hot.exists('k1'))
+
+    def test_delete(self):
+        self.store.store('k1', 1)
+        self.store.delete('k1')
+        self.assertFalse(self.store.exists('k1'))
+        self.store.store('k2', 2, tag='b')
+        self.store.delete_by_tag('b')
+        self.assertFalse(self.store.exists('k2'))
+
+    def test_cold_changes_invalidate(self):
+        hot = SharedMemoryStore(f'devcache_test_{uuid.uuid4().hex[:12]}', slots=8, slot_size=1024)
+        try:
+            store = TieredStore(hot, self.cold)
+            store.store('k', 1, tag='crm')
+            self.assertTrue(hot.exists('k'))
+            self.cold.purge(tag='crm')
+            self.assertIsNone(store.get('k'))
+            store.store('k', 1)
+            self.cold.store('k', 2)
+            self.assertEqual(store.get('k'), 2)
+            TieredStore(hot, self.cold)
+            self.assertEqual(self.cold.listeners.count(hot), 1)
+        finally:
+            hot.close()
+            hot.unlink()
+
 
 if __name__ == '__main__':
     unittest.main()